@@ -26,9 +26,20 @@ def get_livecode_files():
 
     return LIVECODE_FILES
 
+LIVECODE_FILES_JSON = None
+
+def get_livecode_files_json():
+    """Returns the livecode files serialized as JSON.
+
+    The files don't change once loaded, so they are serialized only once.
+    """
+    global LIVECODE_FILES_JSON
+    if LIVECODE_FILES_JSON is None:
+        LIVECODE_FILES_JSON = json.dumps(get_livecode_files())
+    return LIVECODE_FILES_JSON
+
 def main():
-    livecode_files = get_livecode_files()
-    livecode_json = json.dumps(livecode_files)
+    livecode_json = get_livecode_files_json()
 
     js = f"const LIVECODE_FILES = {livecode_json};"
     write_file("../public/js/livecode-files.js", js)
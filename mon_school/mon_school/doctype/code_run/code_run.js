@@ -2,7 +2,13 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('Code Run', {
-	// refresh: function(frm) {
-
-	// }
+	refresh: function(frm) {
+		let result = frm.doc.__onload && frm.doc.__onload.result_pretty;
+		if (result) {
+			frm.dashboard.add_section(
+				`<pre>${frappe.utils.escape_html(result)}</pre>`,
+				__("Result"));
+			frm.dashboard.show();
+		}
+	}
 });
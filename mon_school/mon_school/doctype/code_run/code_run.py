@@ -1,8 +1,15 @@
 # Copyright (c) 2021, FOSS United and contributors
 # For license information, please see license.txt
 
-# import frappe
+import json
 from frappe.model.document import Document
 
 class CodeRun(Document):
-	pass
+	def onload(self):
+		# the result is stored as compact json, pretty print it for viewing
+		# without touching the field, so that saving the form keeps it compact
+		if self.result:
+			try:
+				self.set_onload("result_pretty", json.dumps(json.loads(self.result), indent="  "))
+			except ValueError:
+				pass
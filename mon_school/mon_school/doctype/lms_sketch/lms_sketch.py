@@ -3,8 +3,7 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
-import hashlib
-from urllib.parse import urlparse
+from functools import cached_property
 import frappe
 from frappe.model.document import Document
 from ... import livecode
@@ -14,11 +13,30 @@ DEFAULT_IMAGE = """
 </svg>
 """
 
+# fields required to list sketches, the code is needed for the image url
+LIST_FIELDS = ["name", "title", "owner", "modified", "code", "runtime"]
+
+# fields of the owner in get_owner_summary, used by sketch_card.html
+OWNER_FIELDS = ["name", "username", "full_name", "user_image"]
+
 class LMSSketch(Document):
     def before_save(self):
+        self.__dict__.pop("_code_hash", None)
+
+        # nothing to draw
+        if not self.code or not self.code.strip():
+            self.svg = ""
+            return
+
+        # the code hasn't changed, no need to render again
+        old = self.get_doc_before_save()
+        if old and old.code == self.code and old.runtime == self.runtime and old.svg:
+            self.svg = old.svg
+            return
+
         try:
             is_sketch = self.runtime == "sketch" # old version
-            self.svg = livecode.livecode_to_svg(self.code, is_sketch=is_sketch)
+            self.svg = livecode.livecode_to_svg(self.code, is_sketch=is_sketch, code_hash=self._code_hash)
         except Exception:
             frappe.log_error(f"Failed to save svg for sketch {self.name}")
 
@@ -26,16 +44,15 @@ class LMSSketch(Document):
         if self.svg:
             return self.svg
 
-        h = hashlib.md5(self.code.encode('utf-8')).hexdigest()
         cache = frappe.cache()
-        key = "sketch-" + h
+        key = "sketch-" + self._code_hash
         value = cache.get(key)
         if value:
             value = value.decode('utf-8')
         else:
             is_sketch = self.runtime == "sketch" # old version
             try:
-                value = livecode.livecode_to_svg(self.code, is_sketch=is_sketch)
+                value = livecode.livecode_to_svg(self.code, is_sketch=is_sketch, code_hash=self._code_hash)
             except Exception as e:
                 print(f"Failed to render {self.name} as svg: {e}")
                 pass
@@ -43,6 +60,14 @@ class LMSSketch(Document):
                 cache.set(key, value)
         return value or DEFAULT_IMAGE
 
+    @staticmethod
+    def compute_code_hashes(sketches):
+        """Computes the code hashes of all the sketches that don't have one yet.
+        """
+        for s in sketches:
+            if "_code_hash" not in s.__dict__:
+                s._code_hash = livecode.get_code_hash(s.code)
+
     @property
     def sketch_id(self):
         """Returns the numeric part of the name.
@@ -51,10 +76,18 @@ class LMSSketch(Document):
         """
         return self.name.replace("SKETCH-", "")
 
+    @cached_property
+    def _code_hash(self):
+        """The blake2b hash of the code, computed once per instance.
+
+        This must be invalidated whenever the code is changed.
+        """
+        return livecode.get_code_hash(self.code)
+
     def get_hash(self):
-        """Returns the md5 hash of the code to use for caching.
+        """Returns the hash of the code to use for caching.
         """
-        return hashlib.md5(self.code.encode("utf-8")).hexdigest()
+        return self._code_hash
 
     def get_image_url(self, mode="s"):
         """Returns the image_url for this sketch.
@@ -62,57 +95,84 @@ class LMSSketch(Document):
         The mode argument could be one of "s" (for square)
         or "w" (for wide). The s is the default.
         """
-        hash_ = self.get_hash()
-        return f"/s/{self.sketch_id}-{hash_}-{mode}.png"
+        return f"/s/{self.sketch_id}-{self._code_hash}-{mode}.png"
 
     def get_owner(self):
         """Returns the owner of this sketch as a document.
         """
         return frappe.get_doc("User", self.owner)
 
+    def get_owner_summary(self):
+        """Returns only the OWNER_FIELDS of the owner of this sketch as a dict.
+
+        The summaries of the sketches from get_recent_sketches are
+        prefetched in a single query.
+        """
+        owner = self.__dict__.get("_owner_summary")
+        if owner is None:
+            owner = self._owner_summary = frappe.db.get_value(
+                "User", self.owner, OWNER_FIELDS, as_dict=True)
+        return owner
+
     def get_owner_name(self):
-        return self.get_owner().full_name
+        return self.get_owner_summary().full_name
 
-    def get_livecode_url(self):
+    @cached_property
+    def _livecode_url(self):
         doc = frappe.get_cached_doc("LMS Settings")
         return doc.livecode_url
 
+    @cached_property
+    def _livecode_ws_url(self):
+        return livecode.to_livecode_ws_url(self._livecode_url)
+
+    def get_livecode_url(self):
+        return self._livecode_url
+
     def get_livecode_ws_url(self):
-        url = urlparse(self.get_livecode_url())
-        protocol = "wss" if url.scheme == "https" else "ws"
-        return protocol + "://" + url.netloc + "/livecode"
+        return self._livecode_ws_url
 
     def to_svg(self):
         return self.svg or self.render_svg()
 
-    def render_svg(self):
-        h = hashlib.md5(self.code.encode('utf-8')).hexdigest()
-        cache = frappe.cache()
-        key = "sketch-" + h
-        value = cache.get(key)
-        if value:
-            value = value.decode('utf-8')
-        else:
-            value = livecode.livecode_to_svg(self.code)
-            if value:
-                cache.set(key, value)
-        return value or DEFAULT_IMAGE
-
     @staticmethod
-    def get_recent_sketches(limit=100, owner=None):
+    def get_recent_sketches(limit=100, owner=None, fields=None, as_dict=False):
         """Returns the recent sketches.
+
+        Only the fields required for listing the sketches are fetched,
+        unless the fields are specified. The sketches are returned as
+        documents, or as plain dicts when as_dict is True.
         """
         filters = {}
         if owner:
             filters = {"owner": owner}
+        fields = fields or LIST_FIELDS
         sketches = frappe.get_all(
             "LMS Sketch",
             filters=filters,
-            fields='*',
+            fields=fields,
             order_by='modified desc',
             page_length=limit
         )
-        return [frappe.get_doc(doctype='LMS Sketch', **doc) for doc in sketches]
+        if as_dict or not sketches:
+            return sketches
+
+        docs = [frappe.get_doc(doctype='LMS Sketch', **doc) for doc in sketches]
+
+        if "code" in fields or fields == "*":
+            LMSSketch.compute_code_hashes(docs)
+
+        # fetch all the owners in a single query instead of one per sketch
+        owners = list({doc.owner for doc in docs})
+        users = {u.name: u for u in frappe.get_all(
+            "User",
+            filters={"name": ["in", owners]},
+            fields=OWNER_FIELDS)}
+        for doc in docs:
+            user = users.get(doc.owner)
+            if user:
+                doc._owner_summary = user
+        return docs
 
     def __repr__(self):
         return f"<LMSSketch {self.name}>"
@@ -136,6 +196,7 @@ def save_sketch(name, title, code):
             }
         doc.title = title
         doc.code = code
+        doc.__dict__.pop("_code_hash", None)
         doc.svg = ''
         doc.save()
         status = "updated"
@@ -3,8 +3,106 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
+import frappe
 import unittest
+from unittest.mock import patch
+from ... import livecode
+from .lms_sketch import LMSSketch, LIST_FIELDS, OWNER_FIELDS
+
+def make_sketch(**kwargs):
+	return LMSSketch(dict(doctype="LMS Sketch", **kwargs))
 
 class TestLMSSketch(unittest.TestCase):
-	pass
+	def get_recent_sketches(self, sketches, users, **kwargs):
+		"""Calls get_recent_sketches with the sketches and users
+		returned from frappe.get_all and returns the result and the
+		mocked get_all.
+		"""
+		def get_all(doctype, **kw):
+			return sketches if doctype == "LMS Sketch" else users
+
+		with patch.object(frappe, "get_all", side_effect=get_all) as get_all_mock, \
+				patch.object(frappe, "get_doc", side_effect=lambda doctype, **kw: make_sketch(**kw)):
+			result = LMSSketch.get_recent_sketches(**kwargs)
+		return result, get_all_mock
+
+	def test_get_recent_sketches_prefetches_owners(self):
+		sketches = [
+			frappe._dict(name="SKETCH-1", title="one", owner="a@example.com", code="circle()", runtime="python-canvas"),
+			frappe._dict(name="SKETCH-2", title="two", owner="a@example.com", code="rect()", runtime="python-canvas"),
+		]
+		users = [
+			frappe._dict(name="a@example.com", username="a", full_name="Alice", user_image=None)
+		]
+		docs, get_all = self.get_recent_sketches(sketches, users, limit=16)
+
+		self.assertEqual(get_all.call_count, 2)
+		self.assertEqual(get_all.call_args_list[1].kwargs["fields"], OWNER_FIELDS)
+		self.assertEqual(get_all.call_args_list[1].kwargs["filters"], {"name": ["in", ["a@example.com"]]})
+		with patch.object(frappe.db, "get_value") as get_value:
+			self.assertIs(docs[0].get_owner_summary(), users[0])
+			self.assertEqual(docs[1].get_owner_name(), "Alice")
+			get_value.assert_not_called()
+
+	def test_get_recent_sketches_fields(self):
+		sketches = [frappe._dict(name="SKETCH-1", title="one", owner="a@example.com", code="circle()", runtime="python-canvas")]
+		users = [frappe._dict(name="a@example.com", username="a", full_name="Alice", user_image=None)]
+
+		docs, get_all = self.get_recent_sketches(sketches, users, owner="a@example.com")
+		kwargs = get_all.call_args_list[0].kwargs
+		self.assertEqual(kwargs["fields"], LIST_FIELDS)
+		self.assertEqual(kwargs["filters"], {"owner": "a@example.com"})
+		self.assertNotIn("svg", LIST_FIELDS)
+		self.assertIsInstance(docs[0], LMSSketch)
+		self.assertEqual(docs[0].get_image_url(), f"/s/1-{livecode.get_code_hash('circle()')}-s.png")
+
+		docs, get_all = self.get_recent_sketches(sketches, users, fields=["name", "title"])
+		self.assertEqual(get_all.call_args_list[0].kwargs["fields"], ["name", "title"])
+
+	def test_get_recent_sketches_as_dict(self):
+		sketches = [frappe._dict(name="SKETCH-1", title="one", owner="a@example.com")]
+		result, get_all = self.get_recent_sketches(sketches, [], as_dict=True, fields=["name", "title", "owner"])
+		self.assertIs(result, sketches)
+		get_all.assert_called_once()
+
+	def before_save(self, sketch, old=None):
+		"""Runs before_save of the sketch, with old as the saved version,
+		and returns the mocked livecode_to_svg.
+		"""
+		with patch.object(sketch, "get_doc_before_save", return_value=old, create=True), \
+				patch.object(livecode, "livecode_to_svg", return_value="<svg>new</svg>") as livecode_to_svg:
+			sketch.before_save()
+		return livecode_to_svg
+
+	def test_before_save_renders(self):
+		sketch = make_sketch(name="SKETCH-1", code="circle()", runtime="python-canvas", svg="")
+		livecode_to_svg = self.before_save(sketch)
+		livecode_to_svg.assert_called_once()
+		self.assertEqual(sketch.svg, "<svg>new</svg>")
+
+	def test_before_save_empty_code(self):
+		sketch = make_sketch(name="SKETCH-1", code="  \n", runtime="python-canvas", svg="<svg>old</svg>")
+		livecode_to_svg = self.before_save(sketch)
+		livecode_to_svg.assert_not_called()
+		self.assertEqual(sketch.svg, "")
+
+	def test_before_save_unchanged_code(self):
+		old = make_sketch(name="SKETCH-1", code="circle()", runtime="python-canvas", svg="<svg>old</svg>")
+		sketch = make_sketch(name="SKETCH-1", code="circle()", runtime="python-canvas", svg="")
+		livecode_to_svg = self.before_save(sketch, old)
+		livecode_to_svg.assert_not_called()
+		self.assertEqual(sketch.svg, "<svg>old</svg>")
+
+	def test_before_save_changed_runtime(self):
+		old = make_sketch(name="SKETCH-1", code="circle()", runtime="sketch", svg="<svg>old</svg>")
+		sketch = make_sketch(name="SKETCH-1", code="circle()", runtime="python-canvas", svg="")
+		livecode_to_svg = self.before_save(sketch, old)
+		livecode_to_svg.assert_called_once()
+		self.assertEqual(sketch.svg, "<svg>new</svg>")
+
+	def test_compute_code_hashes(self):
+		sketches = [make_sketch(code="circle()"), make_sketch(code="rect()")]
+		sketches[1]._code_hash = "cached"
+		LMSSketch.compute_code_hashes(sketches)
+		self.assertEqual(sketches[0].get_hash(), livecode.get_code_hash("circle()"))
+		self.assertEqual(sketches[1].get_hash(), "cached")
@@ -2,11 +2,57 @@
 """
 from __future__ import annotations
 import frappe
+from frappe.utils import add_to_date, now_datetime
 import json
-import html
+import hashlib
+import queue
+from collections import OrderedDict
+from functools import lru_cache
+import threading
 from urllib.parse import urlparse
 import websocket
-from ..joy.build import get_livecode_files
+from ..joy.build import get_livecode_files_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson is used for the livecode messages when it is available
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            # orjson rejects what it can't encode as utf-8, like lone
+            # surrogates, which json encodes as escapes
+            return json.dumps(obj)
+else:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+# Idle websocket connections to the livecode server, kept per worker
+# and keyed by the livecode url, so that every execution need not pay
+# for a fresh handshake.
+_WS_POOL = {}
+_WS_POOL_LOCK = threading.Lock()
+WS_POOL_SIZE = 4
+
+# Recently rendered svgs, keyed by (hash of code, is_sketch).
+# Only successful renders are kept, so that a transient failure of the
+# livecode server doesn't stick around.
+_SVG_CACHE = OrderedDict()
+_SVG_CACHE_LOCK = threading.Lock()
+SVG_CACHE_SIZE = 512
+
+def _get_ws_pool(livecode_url):
+    with _WS_POOL_LOCK:
+        pool = _WS_POOL.get(livecode_url)
+        if pool is None:
+            pool = _WS_POOL[livecode_url] = queue.Queue(maxsize=WS_POOL_SIZE)
+        return pool
 
 @frappe.whitelist(allow_guest=True)
 def execute(code: str, is_sketch=False, context=None) -> LiveCodeResult:
@@ -29,13 +75,43 @@ def execute(code: str, is_sketch=False, context=None) -> LiveCodeResult:
     livecode_url = frappe.get_cached_doc("LMS Settings").livecode_url
     livecode = LiveCode(livecode_url)
     result = livecode.execute(code, is_sketch=is_sketch)
-    record_code_run(code, result, context)
-    return result.as_dict()
+    result_dict = result.as_dict()
+
+    # recording the run is not needed for the response, so don't keep
+    # the user waiting for it. It is best-effort, like the recording
+    # itself, so a failure to enqueue must not fail the execution.
+    try:
+        frappe.enqueue(
+            "mon_school.mon_school.livecode.record_code_run",
+            queue="short",
+            code=code,
+            result_dict=result_dict,
+            context=context)
+    except Exception:
+        print("Failed to enqueue recording the code run")
+        import traceback
+        traceback.print_exc()
+    return result_dict
+
+def to_livecode_ws_url(livecode_url):
+    """Returns the websocket url of the livecode server at livecode_url.
+    """
+    url = urlparse(livecode_url)
+    protocol = "wss" if url.scheme == "https" else "ws"
+    return protocol + "://" + url.netloc + "/livecode"
 
-def record_code_run(code, result, context=None):
+# repeated runs of the same code by a user within these many minutes
+# are recorded only once
+CODE_RUN_DEDUPE_MINUTES = 5
+
+def record_code_run(code, result_dict, context=None):
     """Records the code execution.
+
+    This runs as a background job, with the result of the execution
+    passed as a dict.
     """
     context = context or {}
+    result = LiveCodeResult.from_dict(result_dict)
 
     course = context.get("course")
     lesson = context.get("lesson")
@@ -51,6 +127,22 @@ def record_code_run(code, result, context=None):
     else:
         source_type = "Example"
 
+    # Skip recording the same run again by the same user. The digest
+    # covers the outcome and where the code was run from, so that a
+    # failed run followed by a successful one, or the same code run in
+    # another lesson, is still recorded. Guests can't be told apart, so
+    # their runs are always recorded.
+    run_digest = get_code_hash("\0".join(str(v or "") for v in [
+        code, result.status, result.error_code, source_type,
+        course, lesson, batch, sketch, exercise, example]))[:16]
+    if frappe.session.user != "Guest":
+        recently = add_to_date(now_datetime(), minutes=-CODE_RUN_DEDUPE_MINUTES)
+        if frappe.db.exists("Code Run", {
+                "run_digest": run_digest,
+                "owner": frappe.session.user,
+                "modified": [">", recently]}):
+            return
+
     if result.status == "failed":
         failure_type, error = result.find_exception_details()
     else:
@@ -60,7 +152,8 @@ def record_code_run(code, result, context=None):
         doc = frappe.get_doc({
             "doctype": "Code Run",
             "code": code,
-            "result": json.dumps(result.as_dict(), indent="  "),
+            "run_digest": run_digest,
+            "result": json.dumps(result_dict, separators=(",", ":")),
             "status": result.status.title(), # status is Success|Failed in the db
             "error": result.error_code,
             "course": course,
@@ -80,42 +173,131 @@ def record_code_run(code, result, context=None):
         import traceback
         traceback.print_exc()
 
-def livecode_to_svg(code, is_sketch=False):
+def get_code_hash(code):
+    """Returns the hash of the code to use as a cache key.
+    """
+    return hashlib.blake2b(code.encode("utf-8"), digest_size=16).hexdigest()
+
+def livecode_to_svg(code, is_sketch=False, code_hash=None):
     """Renders the code as svg.
+
+    The svgs are memoized in the worker, so rendering the same code
+    again doesn't go to the livecode server. The caller can pass
+    code_hash if it already has the hash of the code.
     """
+    if not isinstance(code, str):
+        return _livecode_to_svg(code, is_sketch)
+
+    key = (code_hash or get_code_hash(code), is_sketch)
+    with _SVG_CACHE_LOCK:
+        svg = _SVG_CACHE.get(key)
+        if svg is not None:
+            _SVG_CACHE.move_to_end(key)
+            return svg
+
+    svg = _livecode_to_svg(code, is_sketch)
+    if svg is not None:
+        with _SVG_CACHE_LOCK:
+            _SVG_CACHE[key] = svg
+            if len(_SVG_CACHE) > SVG_CACHE_SIZE:
+                _SVG_CACHE.popitem(last=False)
+    return svg
+
+def _livecode_to_svg(code, is_sketch):
     result = execute(code, is_sketch=is_sketch)
     if result.get('status') != 'success':
         return None
 
     return _render_svg(result['shapes'])
 
-def _render_svg(shapes):
-    return (
-        '<svg width="300" height="300" viewBox="-150 -150 300 300" fill="none" stroke="black" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
-        + "\n".join(_render_shape(s) for s in shapes)
-        + '\n'
-        + '</svg>\n')
+# same as html.escape, but in a single pass
+_ESCAPE_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#x27;"
+})
 
-def _render_shape(node):
-    tag = node.pop("tag")
-    children = node.pop("children", None)
+def _escape_attr_value(v):
+    # numbers never need escaping
+    if isinstance(v, (int, float)):
+        return str(v)
+    return str(v).translate(_ESCAPE_TABLE)
 
-    items = [(k.replace("_", "-"), html.escape(str(v))) for k, v in node.items() if v is not None]
-    attrs = " ".join(f'{name}="{value}"' for name, value in items)
+@lru_cache(maxsize=64)
+def _attr_name(k):
+    return k.replace("_", "-")
+
+SVG_HEADER = '<svg width="300" height="300" viewBox="-150 -150 300 300" fill="none" stroke="black" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+
+def _render_svg(shapes):
+    parts = [SVG_HEADER]
+    for i, shape in enumerate(shapes):
+        if i:
+            parts.append("\n")
+        _emit_shape(shape, parts)
+    parts.append("\n</svg>\n")
+    return "".join(parts)
+
+def _emit_shape(node, out):
+    """Appends the svg fragments of the shape node to the list out.
+
+    The fragments of the whole tree are collected in a single list
+    so that the svg can be built with one join at the end.
+    """
+    tag = node["tag"]
+    children = node.get("children")
+
+    out.append("<")
+    out.append(tag)
+    out.append(" ")
+    first = True
+    for k, v in node.items():
+        if v is None or k == "tag" or k == "children":
+            continue
+        if not first:
+            out.append(" ")
+        first = False
+        out.append(_attr_name(k))
+        out.append('="')
+        out.append(_escape_attr_value(v))
+        out.append('"')
 
     if children:
-        children_svg = "\n".join(_render_shape(c) for c in children)
-        return f"<{tag} {attrs}>{children_svg}</{tag}>"
+        out.append(">")
+        for i, c in enumerate(children):
+            if i:
+                out.append("\n")
+            _emit_shape(c, out)
+        out.append("</")
+        out.append(tag)
+        out.append(">")
     else:
-        return f"<{tag} {attrs} />"
+        out.append(" />")
+
+TRACEBACK_HEADER = "Traceback (most recent call last):"
 
 class LiveCodeResult:
+    __slots__ = ("status", "error_code", "output", "shapes")
+
     def __init__(self):
         self.status = "success"
         self.error_code = None
         self.output = []
         self.shapes = []
 
+    @classmethod
+    def from_dict(cls, d):
+        """Creates the result back from the output of as_dict.
+        """
+        result = cls()
+        result.status = d["status"]
+        result.error_code = d["error_code"]
+        result.output = d["output"]
+        result.shapes = d["shapes"]
+        return result
+
     def mark_failed(self, error_code):
         self.status = "failed"
         self.error_code = error_code
@@ -126,17 +308,35 @@ class LiveCodeResult:
         if self.status != "failed" or not self.output:
             return None, None
 
-        output = "".join(self.output)
-
         # not an exception
-        if "Traceback (most recent call last):" not in output:
+        if not self._has_traceback():
             return None, None
 
-
-        if ":" in self.output[-1]:
-            exctype, message = self.output[-1].split(":", 1)
-
-        return exctype.strip(), message.strip()
+        # exceptions like KeyboardInterrupt don't have a message
+        exctype, _, message = self._last_line().partition(":")
+        return exctype.strip(), message.strip() or None
+
+    def _last_line(self):
+        # the last line may be split across output chunks, so the chunks
+        # are taken from the end until a complete non-blank line is found
+        text = ""
+        for s in reversed(self.output):
+            text = s + text
+            head, sep, line = text.rstrip().rpartition("\n")
+            if sep and line.strip():
+                return line
+        return text.strip()
+
+    def _has_traceback(self):
+        # the header may be split across output chunks, so each chunk is
+        # checked along with the tail of the previous one
+        n = len(TRACEBACK_HEADER) - 1
+        tail = ""
+        for s in self.output:
+            if TRACEBACK_HEADER in tail + s:
+                return True
+            tail = (tail + s)[-n:]
+        return False
 
     def add_output(self, output):
         self.output.append(output)
@@ -145,67 +345,108 @@ class LiveCodeResult:
         self.shapes.append(shape)
 
     def as_dict(self):
-        return dict(self.__dict__)
-
-    def _render_shape(self, shape):
-        tag = shape
-
-    def as_svg(self):
-        return (
-            '<svg width="300" height="300" viewBox="-150 -150 300 300" fill="none" stroke="black" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
-            + "\n".join(self._render_shape(s) for s in self.shapes)
-            + '\n'
-            + '</svg>\n')
+        return {
+            "status": self.status,
+            "error_code": self.error_code,
+            "output": self.output,
+            "shapes": self.shapes
+        }
 
 class LiveCode:
     def __init__(self, livecode_url, timeout=3):
         self.livecode_url = livecode_url
         self.timeout = timeout
+        self._ws_url = to_livecode_ws_url(livecode_url)
 
     def get_livecode_ws_url(self):
-        url = urlparse(self.livecode_url)
-        protocol = "wss" if url.scheme == "https" else "ws"
-        return protocol + "://" + url.netloc + "/livecode"
+        return self._ws_url
 
     def execute(self, code, is_sketch=False):
         result = LiveCodeResult()
-        try:
-            ws = self.get_websocket()
-        except (IOError, websocket.WebSocketException):
-            result.mark_failed("connection-failed")
-            return result
 
         env = {}
         if is_sketch:
             env['SKETCH'] = "yes"
 
-        msg = {
-            "msgtype": "exec",
-            "runtime": "python",
-            "code": code,
-            "env": env,
-            "files": get_livecode_files(),
-            "command": ["python", "start.py"]
-        }
+        # The files are the bulk of the message and never change, so the
+        # message is assembled around their pre-serialized JSON.
+        msg = (
+            '{"msgtype": "exec", "runtime": "python"'
+            + ', "code": ' + _json_dumps(code)
+            + ', "env": ' + _json_dumps(env)
+            + ', "files": ' + get_livecode_files_json()
+            + ', "command": ["python", "start.py"]}')
+        messages = []
+        ws = self._checkout_websocket()
+        if ws is not None:
+            # A stale pooled connection often accepts the message and then
+            # fails on reading, returns nothing after the server's close
+            # frame, or just times out. Whichever way, if nothing came
+            # back the code didn't run, so retry on a fresh connection.
+            failed = False
+            try:
+                self._exchange(ws, msg, messages)
+            except (IOError, websocket.WebSocketException):
+                failed = True
+            if failed or not messages:
+                ws.close()
+                ws = None
+            if failed and messages:
+                result.mark_failed('connection-reset')
+
+        if ws is None and not messages:
+            try:
+                ws = self.get_websocket()
+            except (IOError, websocket.WebSocketException):
+                result.mark_failed("connection-failed")
+                return result
+            try:
+                self._exchange(ws, msg, messages)
+            except (IOError, websocket.WebSocketException):
+                result.mark_failed('connection-reset')
+
         exit_status = -1
-        try:
-            ws.send(json.dumps(msg))
-            messages = self._read_messages(ws)
-
-            for m in messages:
-                if m['msgtype'] == 'write':
-                    result.add_output(m['data'])
-                elif m['msgtype'] == 'shape':
-                    result.add_shape(m['shape'])
-                elif m['msgtype'] == 'exitstatus':
-                    exit_status = m['exitstatus']
-        except (IOError, websocket.WebSocketException):
-            result.mark_failed('connection-reset')
-
-        if exit_status != 0:
+        for m in messages:
+            if m['msgtype'] == 'write':
+                result.add_output(m['data'])
+            elif m['msgtype'] == 'shape':
+                result.add_shape(m['shape'])
+            elif m['msgtype'] == 'exitstatus':
+                exit_status = m['exitstatus']
+
+        if exit_status == 0 and result.error_code is None:
+            self.release_websocket(ws)
+        else:
+            if ws is not None:
+                ws.close()
             result.status = "failed"
         return result
 
+    def _exchange(self, ws, payload, messages):
+        """Sends the payload and reads the messages of the execution
+        into the list messages.
+        """
+        ws.send(payload)
+        self._read_messages(ws, messages)
+
+    def _checkout_websocket(self):
+        """Returns an idle websocket from the pool or None if there isn't one.
+        """
+        try:
+            ws = _get_ws_pool(self.livecode_url).get_nowait()
+        except queue.Empty:
+            return None
+        ws.settimeout(self.timeout)
+        return ws
+
+    def release_websocket(self, ws):
+        """Returns the websocket to the pool for reuse.
+        """
+        try:
+            _get_ws_pool(self.livecode_url).put_nowait(ws)
+        except queue.Full:
+            ws.close()
+
     def get_websocket(self):
         ws = websocket.WebSocket()
         ws.settimeout(self.timeout)
@@ -213,14 +454,26 @@ class LiveCode:
         ws.connect(livecode_ws_url)
         return ws
 
-    def _read_messages(self, ws):
-        messages = []
+    def _read_messages(self, ws, messages=None):
+        """Reads the messages of one execution.
+
+        The server doesn't close the connection after the execution, so
+        the exitstatus message is taken as the end of the messages.
+
+        The messages are appended to the messages list, when given, so
+        that the caller has the messages received before an error.
+        """
+        if messages is None:
+            messages = []
         try:
             while True:
                 msg = ws.recv()
                 if not msg:
                     break
-                messages.append(json.loads(msg))
+                m = _json_loads(msg)
+                messages.append(m)
+                if m.get("msgtype") == "exitstatus":
+                    break
         except websocket.WebSocketTimeoutException as e:
             print("Error:", e)
             pass
@@ -0,0 +1,317 @@
+# Copyright (c) 2021, FOSS United and Contributors
+# See license.txt
+
+import html
+import json
+import random
+import unittest
+from unittest.mock import patch
+
+import frappe
+import websocket
+from mon_school.mon_school import livecode
+from mon_school.mon_school.livecode import LiveCode, LiveCodeResult, _render_svg
+
+class FakeWebSocket:
+    """Stand-in for websocket.WebSocket that replays canned messages.
+
+    The stale argument makes the socket behave like a connection that
+    was closed by the server. It accepts messages and then, when reading,
+    either raises an "error", returns "" like after a "close" frame, or
+    raises a "timeout".
+    """
+    def __init__(self, messages=(), stale=None):
+        self.messages = [json.dumps(m) for m in messages]
+        self.stale = stale
+        self.sent = []
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, payload):
+        self.sent.append(payload)
+
+    def recv(self):
+        if self.stale == "close":
+            return ""
+        elif self.stale == "timeout":
+            raise websocket.WebSocketTimeoutException("timed out")
+        elif self.stale or not self.messages:
+            raise websocket.WebSocketConnectionClosedException("closed")
+        return self.messages.pop(0)
+
+    def close(self):
+        self.closed = True
+
+class TestLiveCode(unittest.TestCase):
+    def setUp(self):
+        livecode._WS_POOL.clear()
+        self.livecode = LiveCode("https://livecode.example.com")
+
+    def test_execute_retries_stale_pooled_connection(self):
+        for mode in ["error", "close", "timeout"]:
+            with self.subTest(mode=mode):
+                livecode._WS_POOL.clear()
+                stale = FakeWebSocket(stale=mode)
+                self.livecode.release_websocket(stale)
+                fresh = FakeWebSocket([
+                    {"msgtype": "write", "data": "hello\n"},
+                    {"msgtype": "exitstatus", "exitstatus": 0}
+                ])
+
+                with patch.object(self.livecode, "get_websocket", return_value=fresh):
+                    result = self.livecode.execute("print('hello')")
+
+                self.assertEqual(result.status, "success")
+                self.assertEqual(result.output, ["hello\n"])
+                self.assertTrue(stale.closed)
+                self.assertEqual(len(fresh.sent), 1)
+                self.assertIs(self.livecode._checkout_websocket(), fresh)
+
+    def test_execute_does_not_rerun_after_partial_output(self):
+        ws = FakeWebSocket([{"msgtype": "write", "data": "hello\n"}])
+        self.livecode.release_websocket(ws)
+
+        with patch.object(self.livecode, "get_websocket") as get_websocket:
+            result = self.livecode.execute("print('hello')")
+
+        get_websocket.assert_not_called()
+        self.assertEqual(result.status, "failed")
+        self.assertEqual(result.error_code, "connection-reset")
+        self.assertEqual(result.output, ["hello\n"])
+        self.assertTrue(ws.closed)
+
+    def test_execute_encodes_lone_surrogates(self):
+        ws = FakeWebSocket([{"msgtype": "exitstatus", "exitstatus": 0}])
+        with patch.object(self.livecode, "get_websocket", return_value=ws):
+            result = self.livecode.execute("print('\ud800')")
+
+        self.assertEqual(result.status, "success")
+        self.assertEqual(json.loads(ws.sent[0])["code"], "print('\ud800')")
+
+class TestLiveCodeResult(unittest.TestCase):
+    def make_failed_result(self, output):
+        result = LiveCodeResult()
+        result.mark_failed(None)
+        result.output = output
+        return result
+
+    def test_find_exception_details(self):
+        result = self.make_failed_result([
+            "Traceback (most recent call last):\n",
+            '  File "main.py", line 1, in <module>\n',
+            "ValueError: bad\n"
+        ])
+        self.assertEqual(result.find_exception_details(), ("ValueError", "bad"))
+
+    def test_find_exception_details_split_header(self):
+        result = self.make_failed_result([
+            "Traceback (most rec",
+            "ent call last):\n",
+            "ValueError: bad\n"
+        ])
+        self.assertEqual(result.find_exception_details(), ("ValueError", "bad"))
+
+    def test_find_exception_details_split_last_line(self):
+        result = self.make_failed_result([
+            "Traceback (most recent call last):\n",
+            "ValueE",
+            "rror: bad",
+            "\n"
+        ])
+        self.assertEqual(result.find_exception_details(), ("ValueError", "bad"))
+
+    def test_find_exception_details_without_message(self):
+        result = self.make_failed_result([
+            "Traceback (most recent call last):\n",
+            "KeyboardInterrupt\n"
+        ])
+        self.assertEqual(result.find_exception_details(), ("KeyboardInterrupt", None))
+
+    def test_find_exception_details_not_an_exception(self):
+        result = self.make_failed_result(["hello\n"])
+        self.assertEqual(result.find_exception_details(), (None, None))
+
+    def test_as_dict_from_dict(self):
+        result = LiveCodeResult()
+        result.add_output("hello\n")
+        result.add_shape({"tag": "circle", "cx": 0, "cy": 0, "r": 50})
+        result.mark_failed("connection-reset")
+
+        d = result.as_dict()
+        self.assertEqual(d, {
+            "status": "failed",
+            "error_code": "connection-reset",
+            "output": ["hello\n"],
+            "shapes": [{"tag": "circle", "cx": 0, "cy": 0, "r": 50}]
+        })
+        self.assertEqual(LiveCodeResult.from_dict(d).as_dict(), d)
+
+def reference_render_svg(shapes):
+    """The straight-forward renderer that _render_svg must match.
+    """
+    def render_shape(node):
+        node = dict(node)
+        tag = node.pop("tag")
+        children = node.pop("children", None)
+        items = [(k.replace("_", "-"), html.escape(str(v))) for k, v in node.items() if v is not None]
+        attrs = " ".join(f'{name}="{value}"' for name, value in items)
+        if children:
+            children_svg = "\n".join(render_shape(c) for c in children)
+            return f"<{tag} {attrs}>{children_svg}</{tag}>"
+        else:
+            return f"<{tag} {attrs} />"
+
+    return (
+        livecode.SVG_HEADER
+        + "\n".join(render_shape(s) for s in shapes)
+        + "\n"
+        + "</svg>\n")
+
+def random_shape(rng, depth=0):
+    shape = {"tag": rng.choice(["circle", "rect", "text", "g"])}
+    for k in rng.sample(["cx", "stroke_width", "fill", "transform", "x"], 3):
+        shape[k] = rng.choice([None, 0, -1.5, True, "red", 'a<b & "c"', "it's"])
+    if depth < 3 and rng.random() < 0.3:
+        shape["children"] = [random_shape(rng, depth+1) for i in range(rng.randint(0, 3))]
+    return shape
+
+class TestRenderSVG(unittest.TestCase):
+    def test_render_svg(self):
+        shapes = [
+            {"tag": "circle", "cx": 0, "cy": 0, "r": 50, "fill": "red", "stroke_width": None},
+            {"tag": "g", "transform": "rotate(45)", "children": [
+                {"tag": "text", "x": 0, "font_size": 10, "text": 'a<b & "c"'}
+            ]}
+        ]
+        self.assertEqual(_render_svg(shapes), (
+            livecode.SVG_HEADER
+            + '<circle cx="0" cy="0" r="50" fill="red" />\n'
+            + '<g transform="rotate(45)">'
+            + '<text x="0" font-size="10" text="a&lt;b &amp; &quot;c&quot;" />'
+            + '</g>\n'
+            + '</svg>\n'))
+
+    def test_render_svg_matches_reference(self):
+        rng = random.Random(42)
+        for i in range(200):
+            shapes = [random_shape(rng) for j in range(rng.randint(0, 5))]
+            self.assertEqual(_render_svg(shapes), reference_render_svg(shapes))
+
+class TestLiveCodeToSVG(unittest.TestCase):
+    def setUp(self):
+        livecode._SVG_CACHE.clear()
+
+    def tearDown(self):
+        livecode._SVG_CACHE.clear()
+
+    def test_livecode_to_svg_is_memoized(self):
+        result = {"status": "success", "shapes": [{"tag": "circle", "r": 50}]}
+        with patch.object(livecode, "execute", return_value=result) as execute:
+            svg = livecode.livecode_to_svg("circle()")
+            self.assertEqual(livecode.livecode_to_svg("circle()"), svg)
+            self.assertEqual(execute.call_count, 1)
+
+            livecode.livecode_to_svg("circle()", is_sketch=True)
+            livecode.livecode_to_svg("rect()")
+            self.assertEqual(execute.call_count, 3)
+
+    def test_livecode_to_svg_does_not_memoize_failures(self):
+        result = {"status": "failed", "shapes": []}
+        with patch.object(livecode, "execute", return_value=result) as execute:
+            self.assertIsNone(livecode.livecode_to_svg("circle("))
+            self.assertIsNone(livecode.livecode_to_svg("circle("))
+            self.assertEqual(execute.call_count, 2)
+
+class TestRecordCodeRun(unittest.TestCase):
+    def record(self, result_dict, context=None, user="test@example.com", exists=False):
+        """Runs record_code_run as user and returns the mocked
+        frappe.db.exists and frappe.get_doc.
+        """
+        session_user = frappe.session.user
+        frappe.session.user = user
+        try:
+            with patch.object(frappe.db, "exists", return_value=exists) as exists_mock, \
+                    patch.object(frappe, "get_doc") as get_doc:
+                livecode.record_code_run("print('hello')", result_dict, context)
+        finally:
+            frappe.session.user = session_user
+        return exists_mock, get_doc
+
+    def make_result_dict(self, status="success"):
+        return {"status": status, "error_code": None, "output": ["hello\n"], "shapes": []}
+
+    def test_record_code_run(self):
+        exists, get_doc = self.record(self.make_result_dict(), {"lesson": "lesson-1"})
+
+        filters = exists.call_args.args[1]
+        doc = get_doc.call_args.args[0]
+        self.assertEqual(filters["run_digest"], doc["run_digest"])
+        self.assertEqual(filters["owner"], "test@example.com")
+        self.assertEqual(filters["modified"][0], ">")
+        self.assertEqual(doc["lesson"], "lesson-1")
+        self.assertEqual(doc["status"], "Success")
+        get_doc.return_value.save.assert_called_once()
+
+    def test_record_code_run_skips_duplicate(self):
+        exists, get_doc = self.record(self.make_result_dict(), exists=True)
+        exists.assert_called_once()
+        get_doc.assert_not_called()
+
+    def test_record_code_run_always_records_guest(self):
+        exists, get_doc = self.record(self.make_result_dict(), user="Guest", exists=True)
+        exists.assert_not_called()
+        get_doc.assert_called_once()
+
+    def test_record_code_run_digest(self):
+        def get_digest(result_dict, context):
+            exists, get_doc = self.record(result_dict, context)
+            return get_doc.call_args.args[0]["run_digest"]
+
+        digest = get_digest(self.make_result_dict(), {"lesson": "lesson-1"})
+        self.assertEqual(get_digest(self.make_result_dict(), {"lesson": "lesson-1"}), digest)
+        self.assertNotEqual(get_digest(self.make_result_dict("failed"), {"lesson": "lesson-1"}), digest)
+        self.assertNotEqual(get_digest(self.make_result_dict(), {"lesson": "lesson-2"}), digest)
+
+class TestExecute(unittest.TestCase):
+    def execute(self, enqueue_error=None):
+        """Runs the whitelisted execute with a canned failed result and
+        returns its return value and the mocked frappe.enqueue.
+        """
+        result = LiveCodeResult()
+        result.add_output("Traceback (most recent call last):\n")
+        result.add_output("ValueError: bad\n")
+        result.status = "failed"
+
+        settings = frappe._dict(livecode_url="https://livecode.example.com")
+        with patch.object(frappe, "get_cached_doc", return_value=settings), \
+                patch.object(LiveCode, "execute", return_value=result), \
+                patch.object(frappe, "enqueue", side_effect=enqueue_error) as enqueue:
+            d = livecode.execute("raise ValueError('bad')", context={"sketch": "SKETCH-1"})
+        return d, enqueue
+
+    def test_execute_enqueues_record_code_run(self):
+        d, enqueue = self.execute()
+        self.assertEqual(d["status"], "failed")
+
+        enqueue.assert_called_once()
+        self.assertEqual(enqueue.call_args.args[0], "mon_school.mon_school.livecode.record_code_run")
+        kwargs = enqueue.call_args.kwargs
+        self.assertEqual(kwargs["result_dict"], d)
+
+        with patch.object(frappe.db, "exists", return_value=False), \
+                patch.object(frappe, "get_doc") as get_doc:
+            livecode.record_code_run(kwargs["code"], kwargs["result_dict"], kwargs["context"])
+
+        doc = get_doc.call_args.args[0]
+        self.assertEqual(doc["status"], "Failed")
+        self.assertEqual(doc["source_type"], "Sketch")
+        self.assertEqual(doc["failure_type"], "ValueError")
+        self.assertEqual(doc["error"], "bad")
+        self.assertEqual(json.loads(doc["result"]), d)
+
+    def test_execute_ignores_enqueue_failure(self):
+        d, enqueue = self.execute(enqueue_error=ConnectionError("redis is down"))
+        enqueue.assert_called_once()
+        self.assertEqual(d["status"], "failed")